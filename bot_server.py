@@ -3,24 +3,40 @@
 🚀 С авто-пингом и отладкой для 24/7 работы
 """
 import os
+import atexit
+import hashlib
+import hmac
 import asyncio
+import itertools
 import logging
-import sqlite3
-import threading
+import queue
+import random
 import time
-import requests
-from datetime import datetime, timezone, timedelta
-from typing import Optional, Dict, List
+from datetime import date, datetime, timezone, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional, Dict, List, Tuple
+
+# HTTP-клиент для авто-пинга (тот же, что использует python-telegram-bot)
+import httpx
 
 # FastAPI
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import ORJSONResponse, Response
+import orjson
 import uvicorn
 
+# База данных
+import aiosqlite
+
 # Telegram
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import RetryAfter
 from telegram.ext import (
     Application, 
+    BaseRateLimiter,
     CommandHandler, 
     CallbackQueryHandler, 
     ContextTypes
@@ -32,150 +48,530 @@ if not TOKEN:
     raise ValueError("❌ Токен бота не найден! Установите TELEGRAM_BOT_TOKEN")
 
 PORT = int(os.getenv("PORT", 10000))
+RENDER_URL = os.getenv("RENDER_EXTERNAL_URL", "https://ded1-8.onrender.com")
+RENDER_HOST = RENDER_URL.split("://", 1)[-1].rstrip("/")
 DATABASE_URL = os.getenv("DATABASE_URL", "breaks.db")
+# Секрет вебхука: путь и заголовок X-Telegram-Bot-Api-Secret-Token.
+# По умолчанию выводится из токена, чтобы сам токен не попадал в URL и логи
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(TOKEN.encode()).hexdigest()
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 4))  # соединений для чтения
+# Потоки executor'а по умолчанию: синхронной работы почти нет,
+# стандартные min(32, CPU + 4) потоков здесь не нужны
+EXECUTOR_WORKERS = int(os.getenv("EXECUTOR_WORKERS", 4))
+MOSCOW_UTC_OFFSET = 3 * 3600  # секунд
+MOSCOW_TZ = timezone(timedelta(seconds=MOSCOW_UTC_OFFSET))
 
 # Настройка логгирования
+# Обработчики только кладут запись в очередь, а запись в stderr
+# выполняет фоновый поток - event loop не ждет вывода логов
+log_queue = queue.Queue(-1)
+log_listener = QueueListener(log_queue, logging.StreamHandler(), respect_handler_level=True)
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
+    datefmt='%Y-%m-%d %H:%M:%S',
+    handlers=[QueueHandler(log_queue)]
 )
+log_listener.start()
+atexit.register(log_listener.stop)  # дописываем оставшиеся записи при выходе
+# httpx пишет INFO на каждый запрос к Bot API и каждый авто-пинг
+logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 # --- FastAPI приложение ---
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Запуск и остановка бота вместе с сервером"""
+    await startup_event()
+    try:
+        yield
+    finally:
+        await shutdown_event()
+
 app = FastAPI(
     title="Telegram Bot для записи на перерывы",
     description="Бот для организации перерывов с авто-пингом для 24/7 работы",
-    version="2.1"
+    version="2.1",
+    default_response_class=ORJSONResponse,  # orjson вместо стандартного json
+    lifespan=lifespan
 )
 
 # Глобальные переменные
 bot_app: Optional[Application] = None
+auto_ping_task: Optional[asyncio.Task] = None
+bot_ready = asyncio.Event()  # выставляется, когда бот запущен и вебхук установлен
+db_pool: Optional["AioSqlitePool"] = None
 startup_time = datetime.now(timezone.utc)
+startup_monotonic = time.monotonic()  # для аптайма: не зависит от перевода часов
 
 # --- БАЗА ДАННЫХ ---
-def init_db():
-    """Инициализация базы данных"""
-    conn = sqlite3.connect(DATABASE_URL)
-    cursor = conn.cursor()
-    
-    # Таблица пользователей
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            first_name TEXT,
-            last_name TEXT,
-            registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Таблица записей на перерывы
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS breaks (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            break_time TEXT,
-            break_date DATE,
-            registration_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (user_id)
+# Настройки соединения действуют только на само соединение,
+# поэтому выполняются для каждого соединения пула
+CONNECTION_PRAGMAS = """
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA busy_timeout=5000;
+    PRAGMA cache_size=-20000;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA mmap_size=268435456;
+"""
+
+class AioSqlitePool:
+    """Пул долгоживущих соединений aiosqlite: один писатель и несколько читателей.
+    В режиме WAL читатели не ждут писателя, а записи идут по одной и не
+    получают SQLITE_BUSY друг от друга"""
+    
+    def __init__(self, database: str, readers: int):
+        self.database = database
+        self.readers = readers
+        self.connections: List[aiosqlite.Connection] = []
+        self.idle_readers: asyncio.Queue = asyncio.Queue()
+        self.write_conn: Optional[aiosqlite.Connection] = None
+        self.write_lock = asyncio.Lock()
+    
+    async def connect(self) -> aiosqlite.Connection:
+        """Открывает и настраивает одно соединение"""
+        # Режим автокоммита: каждый запрос - отдельная транзакция.
+        # Соединения живут весь процесс, поэтому подготовленные запросы
+        # берутся из кэша sqlite3 (ключ - текст запроса)
+        conn = await aiosqlite.connect(
+            self.database, isolation_level=None, cached_statements=256
         )
-    ''')
+        await conn.executescript(CONNECTION_PRAGMAS)
+        self.connections.append(conn)
+        return conn
+    
+    async def open(self):
+        """Открывает соединения пула"""
+        self.write_conn = await self.connect()
+        for _ in range(self.readers):
+            self.idle_readers.put_nowait(await self.connect())
+    
+    @asynccontextmanager
+    async def reader(self):
+        """Берет свободное соединение для чтения на время запроса"""
+        conn = await self.idle_readers.get()
+        try:
+            yield conn
+        finally:
+            self.idle_readers.put_nowait(conn)
+    
+    @asynccontextmanager
+    async def writer(self):
+        """Дает единственное соединение для записи, по одному запросу за раз"""
+        async with self.write_lock:
+            yield self.write_conn
+    
+    def stats(self) -> Dict[str, object]:
+        """Состояние пула для /health"""
+        return {
+            "readers": self.readers,
+            "idle_readers": self.idle_readers.qsize(),
+            "writer_busy": self.write_lock.locked()
+        }
+    
+    async def close(self):
+        """Закрывает все соединения пула"""
+        for conn in self.connections:
+            await conn.close()
+        self.connections.clear()
+        self.write_conn = None
+
+async def init_db():
+    """Открывает пул соединений с базой данных и создает таблицы"""
+    global db_pool
+    
+    db_pool = AioSqlitePool(DATABASE_URL, DB_POOL_SIZE)
+    await db_pool.open()
+    
+    async with db_pool.writer() as conn:
+        # Таблица пользователей
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                last_name TEXT,
+                registration_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Таблица записей на перерывы
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS breaks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                break_time TEXT,
+                break_date DATE,
+                registration_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users (user_id)
+            )
+        ''')
+        
+        # Одна запись на пользователя, дату и время. Индекс уникальный,
+        # поэтому при первом его создании удаляем старые дубликаты
+        async with conn.execute('''
+            SELECT 1 FROM sqlite_master
+            WHERE type = 'index' AND name = 'idx_breaks_user_date'
+        ''') as cursor:
+            has_unique_index = await cursor.fetchone() is not None
+        
+        if not has_unique_index:
+            cursor = await conn.execute('''
+                DELETE FROM breaks WHERE id NOT IN (
+                    SELECT MIN(id) FROM breaks GROUP BY user_id, break_date, break_time
+                )
+            ''')
+            logger.info(f"🧹 Миграция: удалено дубликатов записей: {cursor.rowcount}")
+        
+        await conn.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_breaks_user_date
+            ON breaks (user_id, break_date, break_time)
+        ''')
+        
+        # Расписание на день: поиск по дате, сразу в порядке времени
+        await conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_breaks_date
+            ON breaks (break_date, break_time)
+        ''')
+        
+        # Уже известные пользователи, чтобы после перезапуска не писать их заново
+        rows = await conn.execute_fetchall("SELECT user_id FROM users")
+        known_users.update(row[0] for row in rows)
     
-    conn.commit()
-    conn.close()
-    logger.info("✅ База данных инициализирована")
+    logger.info(f"✅ База данных инициализирована (соединений: 1 на запись, {DB_POOL_SIZE} на чтение)")
+
+async def close_db():
+    """Закрывает соединения с базой данных"""
+    global db_pool
+    
+    if db_pool:
+        await db_pool.close()
+        db_pool = None
+        logger.info("✅ Соединения с базой данных закрыты")
 
 # --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
+@lru_cache(maxsize=1)
+def _moscow_time_at(epoch_minute: int) -> str:
+    """Время по Москве для заданной минуты (форматируется раз в минуту)"""
+    return datetime.fromtimestamp(epoch_minute * 60, MOSCOW_TZ).strftime("%H:%M")
+
 def get_moscow_time() -> str:
     """Получить текущее время по Москве"""
-    moscow_tz = timezone(timedelta(hours=3))
-    return datetime.now(moscow_tz).strftime("%H:%M")
+    return _moscow_time_at(int(time.time()) // 60)
+
+@lru_cache(maxsize=1)
+def _moscow_date_at(epoch_day: int) -> str:
+    """Дата по Москве для номера дня от начала эпохи (форматируется раз в сутки)"""
+    return (date(1970, 1, 1) + timedelta(days=epoch_day)).isoformat()
 
 def get_current_date() -> str:
     """Получить текущую дату в формате YYYY-MM-DD"""
-    return datetime.now(timezone(timedelta(hours=3))).strftime("%Y-%m-%d")
+    return _moscow_date_at((int(time.time()) + MOSCOW_UTC_OFFSET) // 86400)
 
-def get_break_times() -> List[str]:
-    """Возвращает список доступных времен для перерывов"""
-    return ["10:00", "10:30", "11:00", "11:30", "12:00", "12:30", 
-            "13:00", "13:30", "14:00", "14:30", "15:00", "15:30"]
+@lru_cache(maxsize=1)
+def _utc_timestamp_at(epoch_second: int) -> str:
+    """ISO-время UTC для заданной секунды (форматируется раз в секунду)"""
+    return datetime.fromtimestamp(epoch_second, timezone.utc).isoformat()
 
-def save_user_to_db(user_id: int, username: str, first_name: str, last_name: str):
+def get_utc_timestamp() -> str:
+    """Текущее время UTC в ISO-формате с точностью до секунды"""
+    return _utc_timestamp_at(int(time.time()))
+
+def get_uptime() -> str:
+    """Время работы сервера с момента запуска"""
+    return str(timedelta(seconds=int(time.monotonic() - startup_monotonic)))
+
+BREAK_TIMES = ("10:00", "10:30", "11:00", "11:30", "12:00", "12:30", 
+               "13:00", "13:30", "14:00", "14:30", "15:00", "15:30")
+BREAK_TIMES_SET = frozenset(BREAK_TIMES)
+
+def get_break_times() -> Tuple[str, ...]:
+    """Возвращает доступные времена для перерывов"""
+    return BREAK_TIMES
+
+# Пользователи, которые уже есть в БД: повторный /start не трогает базу
+known_users: set = set()
+
+async def save_user_to_db(user_id: int, username: str, first_name: str, last_name: str):
     """Сохраняет пользователя в базу данных"""
-    conn = sqlite3.connect(DATABASE_URL)
-    cursor = conn.cursor()
+    if user_id in known_users:
+        return
     
-    cursor.execute('''
-        INSERT OR IGNORE INTO users (user_id, username, first_name, last_name)
-        VALUES (?, ?, ?, ?)
-    ''', (user_id, username, first_name, last_name))
+    async with db_pool.writer() as conn:
+        await conn.execute('''
+            INSERT OR IGNORE INTO users (user_id, username, first_name, last_name)
+            VALUES (?, ?, ?, ?)
+        ''', (user_id, username, first_name, last_name))
     
-    conn.commit()
-    conn.close()
+    known_users.add(user_id)
 
-def save_break_to_db(user_id: int, break_time: str, break_date: str):
+async def save_break_to_db(user_id: int, break_time: str, break_date: str) -> bool:
     """Сохраняет запись на перерыв в базу данных"""
-    conn = sqlite3.connect(DATABASE_URL)
-    cursor = conn.cursor()
+    # Дубликат отсекает уникальный индекс idx_breaks_user_date
+    async with db_pool.writer() as conn:
+        cursor = await conn.execute('''
+            INSERT OR IGNORE INTO breaks (user_id, break_time, break_date)
+            VALUES (?, ?, ?)
+        ''', (user_id, break_time, break_date))
+    
+    if cursor.rowcount == 0:
+        return False  # уже записан
+    
+    schedule_cache.pop(break_date, None)
+    schedule_loading.pop(break_date, None)
+    return True
+
+async def get_user_breaks(user_id: int, break_date: str) -> List[str]:
+    """Получает перерывы пользователя на указанную дату"""
+    async with db_pool.reader() as conn:
+        rows = await conn.execute_fetchall('''
+            SELECT break_time FROM breaks 
+            WHERE user_id = ? AND break_date = ?
+            ORDER BY break_time
+        ''', (user_id, break_date))
+    
+    return [row[0] for row in rows]
+
+# --- ТЕКСТЫ ---
+# Шаблоны сообщений: в обработчиках только подставляются значения
+WELCOME_TEMPLATE = """
+    👋 Привет, {name}!
+
+    🤖 Я бот для записи на перерывы.
     
-    # Проверяем, не записан ли уже пользователь на это время
-    cursor.execute('''
-        SELECT COUNT(*) FROM breaks 
-        WHERE user_id = ? AND break_date = ? AND break_time = ?
-    ''', (user_id, break_date, break_time))
+    📅 *Сегодня:* {date}
+    ⏰ *Время по Москве:* {time}
     
-    count = cursor.fetchone()[0]
+    *Доступные команды:*
+    /start - Начало работы
+    /debug - Отладка системы 🆕
+    /breaks - Записаться на перерыв
+    /my_breaks - Мои записи
+    /today - Расписание на сегодня
+    /help - Помощь
     
-    if count > 0:
-        conn.close()
-        return False  # Уже записан
+    Выберите действие:
+    """
+
+HELP_TEXT = """
+    🤖 *Помощь по боту*
     
-    # Сохраняем запись
-    cursor.execute('''
-        INSERT INTO breaks (user_id, break_time, break_date)
-        VALUES (?, ?, ?)
-    ''', (user_id, break_time, break_date))
+    *Основные команды:*
+    /start - Начало работы с ботом
+    /debug - Отладка системы (проверка работы)
+    /breaks - Записаться на перерыв
+    /my_breaks - Посмотреть свои записи
+    /today - Расписание на сегодня
+    /help - Эта справка
     
-    conn.commit()
-    conn.close()
-    return True
+    *Как записаться:*
+    1. Нажмите "Записаться на перерыв"
+    2. Выберите удобное время
+    3. Подтвердите запись
+    
+    *Как отменить запись:*
+    Нажмите на время, на которое записаны, чтобы отменить
+    
+    *Время работы:*
+    Бот работает круглосуточно!
+    
+    *Проблемы?*
+    Используйте /debug для проверки системы
+    """
 
-def get_user_breaks(user_id: int, break_date: str) -> List[str]:
-    """Получает перерывы пользователя на указанную дату"""
-    conn = sqlite3.connect(DATABASE_URL)
-    cursor = conn.cursor()
+DEBUG_TEMPLATE = (
+    "🔧 *ОТЛАДКА СИСТЕМЫ*\n\n"
+    "🤖 *Бот:* ✅ Работает\n"
+    "👤 *Ваш ID:* `{user_id}`\n"
+    "👥 *Чат ID:* `{chat_id}`\n"
+    "🕐 *Москва:* {time}\n"
+    "📅 *Дата:* {date}\n"
+    "🗄️ *База данных:* {db_status}\n"
+    "   {db_info}\n"
+    "🌐 *Сервер:* [" + RENDER_HOST + "](" + RENDER_URL + ")\n"
+    "📊 *Статус:* [JSON](" + RENDER_URL + "/status)\n"
+    "🏥 *Health:* [Check](" + RENDER_URL + "/health)\n\n"
+    "*Доступные команды:*\n"
+    "• /start - Главное меню\n"
+    "• /breaks - Запись на перерыв\n"
+    "• /my_breaks - Мои записи\n"
+    "• /today - Расписание\n"
+    "• /help - Помощь\n\n"
+    "_Авто-пинг работает каждые 8 минут_"
+)
+
+BREAKS_MENU_TEMPLATE = """
+    📅 *Запись на перерыв*
     
-    cursor.execute('''
-        SELECT break_time FROM breaks 
-        WHERE user_id = ? AND break_date = ?
-        ORDER BY break_time
-    ''', (user_id, break_date))
+    *Дата:* {date}
+    *Ваши записи:* {breaks}
     
-    breaks = [row[0] for row in cursor.fetchall()]
-    conn.close()
-    return breaks
+    Выберите время перерыва:
+    ✅ - уже записаны
+    🕐 - доступно для записи
+    """
 
-def get_all_breaks(break_date: str) -> Dict[str, List[str]]:
-    """Получает все записи на перерывы на указанную дату"""
-    conn = sqlite3.connect(DATABASE_URL)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT u.username, b.break_time 
-        FROM breaks b
-        JOIN users u ON b.user_id = u.user_id
-        WHERE b.break_date = ?
-        ORDER BY b.break_time
-    ''', (break_date,))
-    
-    breaks = {}
-    for username, break_time in cursor.fetchall():
-        if break_time not in breaks:
-            breaks[break_time] = []
-        breaks[break_time].append(username or "Аноним")
-    
-    conn.close()
+CONFIRM_BREAK_TEMPLATE = """
+    🕐 *Подтверждение записи*
+    
+    *Время:* {break_time}
+    *Дата:* {date}
+    
+    Подтверждаете запись?
+    """
+
+BREAK_REGISTERED_TEMPLATE = """
+        ✅ *Запись подтверждена!*
+        
+        *Время:* {break_time}
+        *Дата:* {date}
+        
+        Вы успешно записаны на перерыв!
+        """
+
+BREAK_EXISTS_TEMPLATE = """
+        ⚠️ *Запись уже существует!*
+        
+        Вы уже записаны на перерыв в {break_time}
+        """
+
+MY_BREAKS_TEMPLATE = """
+        👤 *Ваши записи на сегодня*
+        
+        *Дата:* {date}
+        *Время по Москве:* {time}
+        
+        📋 *Записанные перерывы:*
+        """
+
+NO_BREAKS_TEMPLATE = """
+        👤 *Ваши записи*
+        
+        *Дата:* {date}
+        
+        📭 У вас нет записей на сегодня.
+        Запишитесь на перерыв!
+        """
+
+TODAY_SCHEDULE_TEMPLATE = """
+        📋 *Расписание на сегодня*
+        
+        *Дата:* {date}
+        *Время по Москве:* {time}
+        
+        📅 *Записи:*
+        """
+
+EMPTY_SCHEDULE_TEMPLATE = """
+        📋 *Расписание на сегодня*
+        
+        *Дата:* {date}
+        
+        📭 На сегодня еще нет записей.
+        Будьте первым!
+        """
+
+# --- КЛАВИАТУРЫ ---
+# Неизменяемые клавиатуры собираются один раз при импорте
+MAIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📅 Записаться на перерыв", callback_data="show_breaks")],
+    [InlineKeyboardButton("👤 Мои записи", callback_data="my_breaks")],
+    [InlineKeyboardButton("📋 Расписание на сегодня", callback_data="today_schedule")],
+    [InlineKeyboardButton("🔧 Отладка", callback_data="debug_info")]
+])
+
+# Кнопки времени в двух вариантах: время -> (свободно, уже записан)
+BREAK_TIME_BUTTONS = {
+    break_time: (
+        InlineKeyboardButton(f"🕐 {break_time}", callback_data=f"select_{break_time}"),
+        InlineKeyboardButton(f"✅ {break_time}", callback_data=f"select_{break_time}")
+    )
+    for break_time in BREAK_TIMES
+}
+
+# Сетка времен по две кнопки в ряд (itertools.batched есть только с Python 3.12)
+BREAK_TIME_ROWS = tuple(BREAK_TIMES[i:i + 2] for i in range(0, len(BREAK_TIMES), 2))
+
+BREAKS_MENU_NAV_ROW = [
+    InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu"),
+    InlineKeyboardButton("🔧 Отладка", callback_data="debug_info")
+]
+
+AFTER_REGISTRATION_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📅 Еще одна запись", callback_data="show_breaks")],
+    [InlineKeyboardButton("👤 Мои записи", callback_data="my_breaks")],
+    [InlineKeyboardButton("🔙 В меню", callback_data="back_to_menu")]
+])
+
+MY_BREAKS_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📅 Записаться", callback_data="show_breaks")],
+    [InlineKeyboardButton("📋 Расписание на сегодня", callback_data="today_schedule")],
+    [InlineKeyboardButton("🔙 В меню", callback_data="back_to_menu")]
+])
+
+TODAY_SCHEDULE_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📅 Записаться", callback_data="show_breaks")],
+    [InlineKeyboardButton("👤 Мои записи", callback_data="my_breaks")],
+    [InlineKeyboardButton("🔙 В меню", callback_data="back_to_menu")]
+])
+
+# Клавиатура подтверждения для каждого времени (времен всего 12)
+CONFIRM_MARKUPS = {
+    break_time: InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("✅ Да, записать", callback_data=f"confirm_{break_time}"),
+            InlineKeyboardButton("❌ Нет, отменить", callback_data="show_breaks")
+        ],
+        [InlineKeyboardButton("🔙 Назад", callback_data="show_breaks")]
+    ])
+    for break_time in BREAK_TIMES
+}
+
+# Расписание на дату: break_date -> (время сохранения, записи).
+# Меняется только при новой записи, которая и сбрасывает кэш
+SCHEDULE_CACHE_TTL = 30  # секунд
+schedule_cache: Dict[str, Tuple[float, Dict[str, str]]] = {}
+
+# Загрузки расписания в процессе: одновременные запросы на ту же дату
+# ждут один общий запрос к базе вместо того, чтобы делать свой
+schedule_loading: Dict[str, asyncio.Task] = {}
+
+async def get_all_breaks(break_date: str) -> Dict[str, str]:
+    """Получает все записи на перерывы на указанную дату: время -> имена через запятую"""
+    cached = schedule_cache.get(break_date)
+    if cached and time.monotonic() - cached[0] < SCHEDULE_CACHE_TTL:
+        return cached[1]
+    
+    task = schedule_loading.get(break_date)
+    if task is None:
+        task = asyncio.create_task(fetch_all_breaks(break_date))
+        schedule_loading[break_date] = task
+        task.add_done_callback(lambda done: forget_schedule_loading(break_date, done))
+    # shield: отмена одного ожидающего не обрывает загрузку для остальных
+    return await asyncio.shield(task)
+
+def forget_schedule_loading(break_date: str, task: asyncio.Task):
+    """Убирает завершенную загрузку, если ее еще не заменила более новая"""
+    if schedule_loading.get(break_date) is task:
+        del schedule_loading[break_date]
+
+async def fetch_all_breaks(break_date: str) -> Dict[str, str]:
+    """Читает расписание на дату из базы и кладет его в кэш"""
+    # Имена собирает сам SQLite, одна строка на время
+    async with db_pool.reader() as conn:
+        rows = await conn.execute_fetchall('''
+            SELECT b.break_time, GROUP_CONCAT(COALESCE(u.username, 'Аноним'), ', ')
+            FROM breaks b
+            JOIN users u ON b.user_id = u.user_id
+            WHERE b.break_date = ?
+            GROUP BY b.break_time
+        ''', (break_date,))
+    
+    breaks = dict(rows)
+    # Если за время запроса появилась новая запись, результат уже устарел
+    if schedule_loading.get(break_date) is asyncio.current_task():
+        schedule_cache[break_date] = (time.monotonic(), breaks)
     return breaks
 
 # --- НОВАЯ ФУНКЦИЯ ОТЛАДКИ ---
@@ -191,38 +587,24 @@ async def debug_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Проверяем подключение к базе данных
     db_status = "✅ Работает"
     try:
-        conn = sqlite3.connect(DATABASE_URL)
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM users")
-        user_count = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM breaks")
-        break_count = cursor.fetchone()[0]
-        conn.close()
+        async with db_pool.reader() as conn:
+            async with conn.execute(
+                "SELECT (SELECT COUNT(*) FROM users), (SELECT COUNT(*) FROM breaks)"
+            ) as cursor:
+                user_count, break_count = await cursor.fetchone()
         db_info = f"Пользователей: {user_count}, Записей: {break_count}"
     except Exception as e:
         db_status = f"❌ Ошибка: {str(e)[:50]}"
         db_info = "Не удалось подключиться"
     
     # Формируем ответ
-    response = (
-        f"🔧 *ОТЛАДКА СИСТЕМЫ*\n\n"
-        f"🤖 *Бот:* ✅ Работает\n"
-        f"👤 *Ваш ID:* `{user.id}`\n"
-        f"👥 *Чат ID:* `{chat.id}`\n"
-        f"🕐 *Москва:* {get_moscow_time()}\n"
-        f"📅 *Дата:* {get_current_date()}\n"
-        f"🗄️ *База данных:* {db_status}\n"
-        f"   {db_info}\n"
-        f"🌐 *Сервер:* [ded1-8.onrender.com](https://ded1-8.onrender.com)\n"
-        f"📊 *Статус:* [JSON](https://ded1-8.onrender.com/status)\n"
-        f"🏥 *Health:* [Check](https://ded1-8.onrender.com/health)\n\n"
-        f"*Доступные команды:*\n"
-        f"• /start - Главное меню\n"
-        f"• /breaks - Запись на перерыв\n"
-        f"• /my_breaks - Мои записи\n"
-        f"• /today - Расписание\n"
-        f"• /help - Помощь\n\n"
-        f"_Авто-пинг работает каждые 8 минут_"
+    response = DEBUG_TEMPLATE.format(
+        user_id=user.id,
+        chat_id=chat.id,
+        time=get_moscow_time(),
+        date=get_current_date(),
+        db_status=db_status,
+        db_info=db_info
     )
     
     await update.message.reply_text(response, parse_mode='Markdown', disable_web_page_preview=True)
@@ -237,78 +619,31 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f"🚀 Команда /start от {user.id} ({user.username})")
     
     # Сохраняем пользователя в БД
-    save_user_to_db(
+    await save_user_to_db(
         user_id=user.id,
         username=user.username,
         first_name=user.first_name,
         last_name=user.last_name
     )
     
-    welcome_text = f"""
-    👋 Привет, {user.first_name}!
-
-    🤖 Я бот для записи на перерывы.
-    
-    📅 *Сегодня:* {get_current_date()}
-    ⏰ *Время по Москве:* {get_moscow_time()}
-    
-    *Доступные команды:*
-    /start - Начало работы
-    /debug - Отладка системы 🆕
-    /breaks - Записаться на перерыв
-    /my_breaks - Мои записи
-    /today - Расписание на сегодня
-    /help - Помощь
-    
-    Выберите действие:
-    """
-    
-    keyboard = [
-        [InlineKeyboardButton("📅 Записаться на перерыв", callback_data="show_breaks")],
-        [InlineKeyboardButton("👤 Мои записи", callback_data="my_breaks")],
-        [InlineKeyboardButton("📋 Расписание на сегодня", callback_data="today_schedule")],
-        [InlineKeyboardButton("🔧 Отладка", callback_data="debug_info")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    welcome_text = WELCOME_TEMPLATE.format(
+        name=user.first_name,
+        date=get_current_date(),
+        time=get_moscow_time()
+    )
     
     await context.bot.send_message(
         chat_id=chat_id,
         text=welcome_text,
         parse_mode='Markdown',
-        reply_markup=reply_markup
+        reply_markup=MAIN_MENU_MARKUP
     )
     
     logger.info(f"✅ Ответ /start отправлен {user.id}")
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /help"""
-    help_text = """
-    🤖 *Помощь по боту*
-    
-    *Основные команды:*
-    /start - Начало работы с ботом
-    /debug - Отладка системы (проверка работы)
-    /breaks - Записаться на перерыв
-    /my_breaks - Посмотреть свои записи
-    /today - Расписание на сегодня
-    /help - Эта справка
-    
-    *Как записаться:*
-    1. Нажмите "Записаться на перерыв"
-    2. Выберите удобное время
-    3. Подтвердите запись
-    
-    *Как отменить запись:*
-    Нажмите на время, на которое записаны, чтобы отменить
-    
-    *Время работы:*
-    Бот работает круглосуточно!
-    
-    *Проблемы?*
-    Используйте /debug для проверки системы
-    """
-    
-    await update.message.reply_text(help_text, parse_mode='Markdown')
+    await update.message.reply_text(HELP_TEXT, parse_mode='Markdown')
 
 async def breaks_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /breaks - показывает доступные перерывы"""
@@ -333,31 +668,18 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     logger.info(f"🔘 Callback от {user_id}: {data}")
     
-    if data == "show_breaks":
-        await show_breaks_menu(update, context)
-    
-    elif data == "my_breaks":
-        await show_my_breaks(update, context)
-    
-    elif data == "today_schedule":
-        await show_today_schedule(update, context)
-    
-    elif data == "debug_info":
-        # Имитируем команду /debug через кнопку
-        await debug_command(update, context)
-    
-    elif data.startswith("select_"):
-        # Выбор времени перерыва
-        break_time = data.replace("select_", "")
-        await confirm_break_selection(update, context, break_time)
-    
-    elif data.startswith("confirm_"):
-        # Подтверждение записи
-        break_time = data.replace("confirm_", "")
-        await process_break_registration(update, context, break_time)
+    handler = CALLBACK_ROUTES.get(data)
+    if handler:
+        await handler(update, context)
+        return
     
-    elif data == "back_to_menu":
-        await start_command(update, context)
+    # select_<время> - выбор времени, confirm_<время> - подтверждение записи
+    action, _, break_time = data.partition("_")
+    handler = BREAK_TIME_ROUTES.get(action)
+    if handler and break_time in BREAK_TIMES_SET:
+        await handler(update, context, break_time)
+    else:
+        logger.warning(f"⚠️ Неизвестный callback: {data}")
 
 async def show_breaks_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает меню выбора времени перерыва"""
@@ -365,42 +687,25 @@ async def show_breaks_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = query.from_user.id if query else update.effective_user.id
     
     current_date = get_current_date()
-    user_breaks = get_user_breaks(user_id, current_date)
-    
-    # Создаем клавиатуру с временами
-    keyboard = []
-    break_times = get_break_times()
-    
-    for i in range(0, len(break_times), 2):
-        row = []
-        for j in range(2):
-            if i + j < len(break_times):
-                time = break_times[i + j]
-                # Проверяем, записан ли уже пользователь на это время
-                if time in user_breaks:
-                    row.append(InlineKeyboardButton(f"✅ {time}", callback_data=f"select_{time}"))
-                else:
-                    row.append(InlineKeyboardButton(f"🕐 {time}", callback_data=f"select_{time}"))
-        keyboard.append(row)
+    user_breaks = await get_user_breaks(user_id, current_date)
+    booked = set(user_breaks)
+    
+    # Клавиатура по готовой сетке: вариант кнопки зависит от того,
+    # записан ли уже пользователь на это время
+    keyboard = [
+        [BREAK_TIME_BUTTONS[break_time][break_time in booked] for break_time in row]
+        for row in BREAK_TIME_ROWS
+    ]
     
     # Добавляем кнопки навигации
-    keyboard.append([
-        InlineKeyboardButton("🔙 Назад", callback_data="back_to_menu"),
-        InlineKeyboardButton("🔧 Отладка", callback_data="debug_info")
-    ])
+    keyboard.append(BREAKS_MENU_NAV_ROW)
     
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    text = f"""
-    📅 *Запись на перерыв*
-    
-    *Дата:* {current_date}
-    *Ваши записи:* {', '.join(user_breaks) if user_breaks else 'нет'}
-    
-    Выберите время перерыва:
-    ✅ - уже записаны
-    🕐 - доступно для записи
-    """
+    text = BREAKS_MENU_TEMPLATE.format(
+        date=current_date,
+        breaks=', '.join(user_breaks) if user_breaks else 'нет'
+    )
     
     if query:
         await query.edit_message_text(
@@ -420,28 +725,12 @@ async def confirm_break_selection(update: Update, context: ContextTypes.DEFAULT_
     """Подтверждение выбора времени"""
     query = update.callback_query
     
-    text = f"""
-    🕐 *Подтверждение записи*
-    
-    *Время:* {break_time}
-    *Дата:* {get_current_date()}
-    
-    Подтверждаете запись?
-    """
-    
-    keyboard = [
-        [
-            InlineKeyboardButton("✅ Да, записать", callback_data=f"confirm_{break_time}"),
-            InlineKeyboardButton("❌ Нет, отменить", callback_data="show_breaks")
-        ],
-        [InlineKeyboardButton("🔙 Назад", callback_data="show_breaks")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    text = CONFIRM_BREAK_TEMPLATE.format(break_time=break_time, date=get_current_date())
     
     await query.edit_message_text(
         text=text,
         parse_mode='Markdown',
-        reply_markup=reply_markup
+        reply_markup=CONFIRM_MARKUPS[break_time]
     )
 
 async def process_break_registration(update: Update, context: ContextTypes.DEFAULT_TYPE, break_time: str):
@@ -453,37 +742,19 @@ async def process_break_registration(update: Update, context: ContextTypes.DEFAU
     logger.info(f"📝 Запись на перерыв: user={user_id}, time={break_time}, date={current_date}")
     
     # Сохраняем запись в БД
-    success = save_break_to_db(user_id, break_time, current_date)
+    success = await save_break_to_db(user_id, break_time, current_date)
     
     if success:
-        text = f"""
-        ✅ *Запись подтверждена!*
-        
-        *Время:* {break_time}
-        *Дата:* {current_date}
-        
-        Вы успешно записаны на перерыв!
-        """
+        text = BREAK_REGISTERED_TEMPLATE.format(break_time=break_time, date=current_date)
         logger.info(f"✅ Запись сохранена в БД")
     else:
-        text = f"""
-        ⚠️ *Запись уже существует!*
-        
-        Вы уже записаны на перерыв в {break_time}
-        """
+        text = BREAK_EXISTS_TEMPLATE.format(break_time=break_time)
         logger.info(f"⚠️ Запись уже существует")
     
-    keyboard = [
-        [InlineKeyboardButton("📅 Еще одна запись", callback_data="show_breaks")],
-        [InlineKeyboardButton("👤 Мои записи", callback_data="my_breaks")],
-        [InlineKeyboardButton("🔙 В меню", callback_data="back_to_menu")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     await query.edit_message_text(
         text=text,
         parse_mode='Markdown',
-        reply_markup=reply_markup
+        reply_markup=AFTER_REGISTRATION_MARKUP
     )
 
 async def show_my_breaks(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -492,35 +763,17 @@ async def show_my_breaks(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = query.from_user.id if query else update.effective_user.id
     current_date = get_current_date()
     
-    user_breaks = get_user_breaks(user_id, current_date)
+    user_breaks = await get_user_breaks(user_id, current_date)
     
     if user_breaks:
-        text = f"""
-        👤 *Ваши записи на сегодня*
-        
-        *Дата:* {current_date}
-        *Время по Москве:* {get_moscow_time()}
-        
-        📋 *Записанные перерывы:*
-        """
-        for i, break_time in enumerate(user_breaks, 1):
-            text += f"\n{i}. 🕐 {break_time}"
+        text = MY_BREAKS_TEMPLATE.format(date=current_date, time=get_moscow_time())
+        text += "".join([
+            f"\n{i}. 🕐 {break_time}" for i, break_time in enumerate(user_breaks, 1)
+        ])
     else:
-        text = f"""
-        👤 *Ваши записи*
-        
-        *Дата:* {current_date}
-        
-        📭 У вас нет записей на сегодня.
-        Запишитесь на перерыв!
-        """
+        text = NO_BREAKS_TEMPLATE.format(date=current_date)
     
-    keyboard = [
-        [InlineKeyboardButton("📅 Записаться", callback_data="show_breaks")],
-        [InlineKeyboardButton("📋 Расписание на сегодня", callback_data="today_schedule")],
-        [InlineKeyboardButton("🔙 В меню", callback_data="back_to_menu")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = MY_BREAKS_MARKUP
     
     if query:
         await query.edit_message_text(
@@ -536,45 +789,38 @@ async def show_my_breaks(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=reply_markup
         )
 
+# Готовые строки расписания: дата -> (записи, из которых собраны, текст).
+# Пока get_all_breaks отдает тот же объект из кэша, текст не пересобирается
+schedule_text_cache: Dict[str, Tuple[Dict[str, str], str]] = {}
+
+def render_schedule_rows(break_date: str, all_breaks: Dict[str, str]) -> str:
+    """Строки расписания по всем временам перерывов"""
+    cached = schedule_text_cache.get(break_date)
+    if cached and cached[0] is all_breaks:
+        return cached[1]
+    
+    rows = "".join([
+        f"\n🕐 *{break_time}*: {all_breaks.get(break_time, 'свободно')}"
+        for break_time in get_break_times()
+    ])
+    schedule_text_cache.clear()  # старые даты больше не нужны
+    schedule_text_cache[break_date] = (all_breaks, rows)
+    return rows
+
 async def show_today_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает расписание на сегодня"""
     query = update.callback_query
     current_date = get_current_date()
     
-    all_breaks = get_all_breaks(current_date)
+    all_breaks = await get_all_breaks(current_date)
     
     if all_breaks:
-        text = f"""
-        📋 *Расписание на сегодня*
-        
-        *Дата:* {current_date}
-        *Время по Москве:* {get_moscow_time()}
-        
-        📅 *Записи:*
-        """
-        
-        for break_time in get_break_times():
-            if break_time in all_breaks:
-                users = ", ".join(all_breaks[break_time])
-                text += f"\n🕐 *{break_time}*: {users}"
-            else:
-                text += f"\n🕐 *{break_time}*: свободно"
+        text = TODAY_SCHEDULE_TEMPLATE.format(date=current_date, time=get_moscow_time())
+        text += render_schedule_rows(current_date, all_breaks)
     else:
-        text = f"""
-        📋 *Расписание на сегодня*
-        
-        *Дата:* {current_date}
-        
-        📭 На сегодня еще нет записей.
-        Будьте первым!
-        """
+        text = EMPTY_SCHEDULE_TEMPLATE.format(date=current_date)
     
-    keyboard = [
-        [InlineKeyboardButton("📅 Записаться", callback_data="show_breaks")],
-        [InlineKeyboardButton("👤 Мои записи", callback_data="my_breaks")],
-        [InlineKeyboardButton("🔙 В меню", callback_data="back_to_menu")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = TODAY_SCHEDULE_MARKUP
     
     if query:
         await query.edit_message_text(
@@ -590,6 +836,83 @@ async def show_today_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE
             reply_markup=reply_markup
         )
 
+# Маршруты inline-кнопок: callback_data -> обработчик
+CALLBACK_ROUTES = {
+    "show_breaks": show_breaks_menu,
+    "my_breaks": show_my_breaks,
+    "today_schedule": show_today_schedule,
+    "debug_info": debug_command,  # имитируем команду /debug через кнопку
+    "back_to_menu": start_command
+}
+
+# Кнопки со временем перерыва: префикс callback_data -> обработчик
+BREAK_TIME_ROUTES = {
+    "select": confirm_break_selection,
+    "confirm": process_break_registration
+}
+
+# --- ОГРАНИЧЕНИЕ ЧАСТОТЫ ЗАПРОСОВ К TELEGRAM ---
+TELEGRAM_GLOBAL_RATE = 30  # запросов в секунду на весь бот (лимит Telegram)
+TELEGRAM_CHAT_INTERVAL = 1.0  # секунд между новыми сообщениями в один чат
+TELEGRAM_GROUP_INTERVAL = 60 / 20  # в группу - не больше 20 новых сообщений в минуту
+TELEGRAM_MAX_RETRIES = 2  # повторов после 429 RetryAfter
+TELEGRAM_CHAT_SLOTS_LIMIT = 1000  # после этого размера чистим старые слоты чатов
+
+class TelegramRateLimiter(BaseRateLimiter):
+    """Равномерно распределяет исходящие запросы к Bot API,
+    чтобы при наплыве нажатий не получать 429 Too Many Requests"""
+    
+    def __init__(self, rate: int = TELEGRAM_GLOBAL_RATE):
+        self.interval = 1 / rate
+        self.next_slot = 0.0
+        self.chat_next_slot: Dict[object, float] = {}
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+    
+    def reserve_slot(self, chat_id, endpoint: str, now: float) -> float:
+        """Резервирует время отправки с учетом общего лимита и лимита чата"""
+        slot = max(now, self.next_slot)
+        # Общая очередь не ждет отдельный чат, иначе один чат задерживал бы всех
+        self.next_slot = slot + self.interval
+        # Лимит чата касается только новых сообщений (send*): редактирование
+        # и ответы на нажатия кнопок идут сразу, по общему лимиту
+        if chat_id is not None and endpoint.startswith("send"):
+            if len(self.chat_next_slot) > TELEGRAM_CHAT_SLOTS_LIMIT:
+                self.chat_next_slot = {
+                    chat: chat_slot for chat, chat_slot in self.chat_next_slot.items()
+                    if chat_slot > now
+                }
+            # Группы и каналы (отрицательный id или @username) ограничены строже
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            interval = TELEGRAM_GROUP_INTERVAL if is_group else TELEGRAM_CHAT_INTERVAL
+            slot = max(slot, self.chat_next_slot.get(chat_id, 0.0))
+            self.chat_next_slot[chat_id] = slot + interval
+        return slot
+    
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id") if data else None
+        loop = asyncio.get_running_loop()
+        
+        for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+            # Слот резервируется синхронно, поэтому блокировка не нужна
+            now = loop.time()
+            slot = self.reserve_slot(chat_id, endpoint, now)
+            if slot > now:
+                await asyncio.sleep(slot - now)
+            
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == TELEGRAM_MAX_RETRIES:
+                    raise
+                # Штраф Telegram действует на весь бот: сдвигаем общую очередь
+                logger.warning(f"⏳ Telegram просит подождать {e.retry_after} сек ({endpoint})")
+                self.next_slot = max(self.next_slot, loop.time() + float(e.retry_after))
+
 # --- ЗАПУСК ТЕЛЕГРАМ БОТА С ОТЛАДКОЙ ---
 async def start_bot():
     """Запуск Telegram бота с подробной отладкой"""
@@ -597,14 +920,16 @@ async def start_bot():
     
     logger.info("🤖 Инициализация Telegram бота с отладкой...")
     
-    # Ждем стабилизации сети на Render
-    logger.info("⏳ Ожидание стабилизации сети (5 секунд)...")
-    await asyncio.sleep(5)
-    
     try:
-        # 1. Создаем приложение
+        # 1. Создаем приложение (без Updater - обновления приходят через вебхук)
         logger.info("🛠️ Создание приложения...")
-        bot_app = Application.builder().token(TOKEN).build()
+        bot_app = (
+            Application.builder()
+            .token(TOKEN)
+            .updater(None)
+            .rate_limiter(TelegramRateLimiter())
+            .build()
+        )
         logger.info("✅ Приложение создано")
         
         # 2. ДОБАВЛЯЕМ ОБРАБОТЧИКИ С ЛОГИРОВАНИЕМ
@@ -644,16 +969,18 @@ async def start_bot():
         await bot_app.start()
         logger.info("✅ Бот запущен")
         
-        # 4. Начинаем polling
-        logger.info("📡 Начало polling...")
-        await bot_app.updater.start_polling(
-            poll_interval=1.0,
-            timeout=20,
-            drop_pending_updates=True,
-            allowed_updates=Update.ALL_TYPES
+        # 4. Регистрируем вебхук вместо polling
+        logger.info(f"📡 Установка вебхука на {RENDER_URL}/webhook/...")
+        await bot_app.bot.set_webhook(
+            url=f"{RENDER_URL}/webhook/{WEBHOOK_SECRET}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=["message", "callback_query"],
+            max_connections=40,
+            drop_pending_updates=True
         )
-        logger.info("✅ Polling запущен")
+        logger.info("✅ Вебхук установлен")
         
+        bot_ready.set()
         logger.info("🎉 Telegram бот успешно запущен и готов к работе!")
         return True
         
@@ -664,107 +991,249 @@ async def start_bot():
         return False
 
 # --- ПРОСТОЙ АВТО-ПИНГ ---
-def start_auto_ping():
-    """Запускает простой авто-пинг в отдельном потоке"""
-    def ping_worker():
-        # Ждем полного запуска сервера
-        logger.info("⏳ Авто-пинг: ожидание запуска сервера (30 секунд)...")
-        time.sleep(30)
-        
-        url = "https://ded1-8.onrender.com"
-        logger.info(f"🧵 Авто-пинг запущен для {url}")
-        
-        ping_count = 0
-        while True:
-            ping_count += 1
+PING_INTERVAL = 480       # 8 минут - меньше 15-минутного лимита Render
+PING_ERROR_INTERVAL = 30  # первая повторная попытка после ошибки
+
+def get_ping_interval(consecutive_failures: int) -> float:
+    """Пауза до следующего пинга: после ошибок растет вдвое, но не больше
+    обычного интервала; случайный разброс ±20% разводит пинги во времени"""
+    if consecutive_failures:
+        interval = min(PING_INTERVAL, PING_ERROR_INTERVAL * (1 << min(consecutive_failures - 1, 5)))
+    else:
+        interval = PING_INTERVAL
+    return interval * random.uniform(0.8, 1.2)
+
+async def auto_ping():
+    """Авто-пинг: задача в event loop, без отдельного потока"""
+    # Ждем полного запуска сервера
+    logger.info("⏳ Авто-пинг: ожидание запуска сервера (30 секунд)...")
+    await asyncio.sleep(30)
+    
+    url = RENDER_URL  # тот же хост, на который установлен вебхук
+    logger.info(f"🔁 Авто-пинг запущен для {url}")
+    
+    # Один клиент на весь срок жизни задачи: TCP/TLS-соединение
+    # с Render переиспользуется между пингами (keep-alive)
+    async with httpx.AsyncClient(timeout=10) as client:
+        success_count = 0
+        consecutive_failures = 0
+        for ping_count in itertools.count(1):
             try:
-                response = requests.get(f"{url}/health", timeout=10)
+                response = await client.get(f"{url}/health")
                 if response.status_code == 200:
-                    logger.info(f"✅ Авто-пинг #{ping_count} успешен")
+                    success_count += 1
+                    consecutive_failures = 0
+                    logger.debug(f"✅ Авто-пинг #{ping_count} успешен")
                 else:
+                    consecutive_failures += 1
                     logger.warning(f"⚠️ Авто-пинг #{ping_count}: код {response.status_code}")
             except Exception as e:
+                consecutive_failures += 1
                 logger.error(f"❌ Ошибка авто-пинга #{ping_count}: {e}")
             
-            # Пинг каждые 8 минут (меньше 15-минутного лимита Render)
-            time.sleep(480)
+            # Сводка раз в 10 пингов вместо строки на каждый успешный
+            if ping_count % 10 == 0:
+                logger.info(f"📊 Авто-пинг: {success_count}/{ping_count} успешных")
+            
+            await asyncio.sleep(get_ping_interval(consecutive_failures))
+
+# --- ОЧЕРЕДИ ОБНОВЛЕНИЙ ПО ЧАТАМ ---
+# У каждого чата своя очередь и свой обработчик: порядок обновлений
+# внутри чата сохраняется, а медленный чат не задерживает остальные
+CHAT_WORKER_IDLE_TIMEOUT = 60  # секунд без обновлений до остановки обработчика
+chat_queues: Dict[int, asyncio.Queue] = {}
+chat_workers: Dict[int, asyncio.Task] = {}
+
+def dispatch_update(update: Update):
+    """Ставит обновление в очередь его чата"""
+    if update.effective_chat:
+        chat_id = update.effective_chat.id
+    elif update.effective_user:
+        chat_id = update.effective_user.id
+    else:
+        chat_id = 0
+    
+    chat_queue = chat_queues.get(chat_id)
+    if chat_queue is None:
+        chat_queue = chat_queues[chat_id] = asyncio.Queue()
+        chat_workers[chat_id] = asyncio.create_task(chat_worker(chat_id, chat_queue))
     
-    thread = threading.Thread(target=ping_worker, daemon=True)
-    thread.start()
-    logger.info("✅ Поток авто-пинга создан")
-    return thread
+    chat_queue.put_nowait(update)
+
+async def chat_worker(chat_id: int, chat_queue: asyncio.Queue):
+    """Обрабатывает обновления одного чата по порядку"""
+    try:
+        while True:
+            try:
+                update = await asyncio.wait_for(chat_queue.get(), timeout=CHAT_WORKER_IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                if chat_queue.empty():
+                    break  # чат затих - освобождаем память
+                continue
+            
+            try:
+                await bot_app.process_update(update)
+            except Exception as e:
+                logger.error(f"❌ Ошибка обработки обновления в чате {chat_id}: {e}")
+    finally:
+        chat_queues.pop(chat_id, None)
+        chat_workers.pop(chat_id, None)
+
+async def stop_chat_workers():
+    """Останавливает обработчики чатов"""
+    workers = list(chat_workers.values())
+    for task in workers:
+        task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
 
 # --- FastAPI ЭНДПОИНТЫ ---
+# Готовые JSON-ответы /, /health и /status: путь -> (время сборки, тело).
+# Render и мониторы опрашивают их чаще раза в секунду
+BODY_CACHE_TTL = 1.0  # секунд
+body_cache: Dict[str, Tuple[float, bytes]] = {}
+
+def get_cached_body(key: str) -> Optional[bytes]:
+    """Возвращает тело ответа, если оно собрано меньше секунды назад"""
+    cached = body_cache.get(key)
+    if cached and time.monotonic() - cached[0] < BODY_CACHE_TTL:
+        return cached[1]
+    return None
+
+def store_body(key: str, payload: dict) -> bytes:
+    """Сериализует ответ и запоминает его"""
+    body = orjson.dumps(payload)
+    body_cache[key] = (time.monotonic(), body)
+    return body
+
+# Неизменяемые части ответов собираются один раз при импорте
+ROOT_STATIC = {
+    "message": "🤖 Telegram Bot для записи на перерывы",
+    "status": "running",
+    "version": "2.1",
+    "endpoints": {
+        "health": "/health",
+        "status": "/status",
+        "ping": "/ping",
+        "debug": "Команда /debug в боте"
+    }
+}
+
+HEALTH_STATIC = {
+    "version": "2.1"
+}
+
+STATUS_DEBUG = {
+    "command": "Используйте /debug в боте",
+    "health_check": f"{RENDER_URL}/health"
+}
+
 @app.get("/")
 async def root():
     """Корневой эндпоинт"""
-    return {
-        "message": "🤖 Telegram Bot для записи на перерывы",
-        "status": "running",
-        "bot": "active" if bot_app else "starting",
-        "time_moscow": get_moscow_time(),
-        "date": get_current_date(),
-        "uptime": str(datetime.now(timezone.utc) - startup_time),
-        "version": "2.1",
-        "endpoints": {
-            "health": "/health",
-            "status": "/status",
-            "ping": "/ping",
-            "debug": "Команда /debug в боте"
-        }
-    }
+    body = get_cached_body("root")
+    if body is None:
+        body = store_body("root", {
+            **ROOT_STATIC,
+            "bot": "active" if bot_ready.is_set() else "starting",
+            "time_moscow": get_moscow_time(),
+            "date": get_current_date(),
+            "uptime": get_uptime()
+        })
+    return Response(content=body, media_type="application/json")
+
+async def measure_loop_lag() -> float:
+    """Задержка event loop в мс: сколько ждет задача, уступившая управление"""
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    await asyncio.sleep(0)
+    return round((loop.time() - started) * 1000, 2)
 
 @app.get("/health")
 async def health_check():
     """Health check для Render"""
-    return {
-        "status": "healthy",
-        "timestamp": datetime.now(timezone.utc).isoformat(),
-        "bot_running": bool(bot_app),
-        "time_moscow": get_moscow_time(),
-        "date": get_current_date(),
-        "version": "2.1"
-    }
+    # Запросы принимаются только после завершения startup_event, поэтому
+    # неготовый бот здесь значит, что запуск не удался или бот остановился
+    bot_running = bot_ready.is_set() and bot_app.running
+    
+    # В кэше лежит только ответ здорового сервиса: сбой виден Render сразу
+    body = get_cached_body("health") if bot_running else None
+    if body is None:
+        payload = {
+            **HEALTH_STATIC,
+            "status": "healthy" if bot_running else "unhealthy",
+            "timestamp": get_utc_timestamp(),
+            "bot_running": bot_running,
+            "db_pool": db_pool.stats() if db_pool else None,
+            "loop_lag_ms": await measure_loop_lag(),
+            "time_moscow": get_moscow_time(),
+            "date": get_current_date()
+        }
+        if not bot_running:
+            # 503 - Render выведет сервис из ротации и перезапустит его
+            return Response(content=orjson.dumps(payload), status_code=503, media_type="application/json")
+        body = store_body("health", payload)
+    return Response(content=body, media_type="application/json")
 
 @app.get("/status")
 async def status():
     """Статус системы"""
-    return {
-        "server": {
-            "uptime": str(datetime.now(timezone.utc) - startup_time),
-            "port": PORT,
-            "startup_time": startup_time.isoformat()
-        },
-        "bot": {
-            "initialized": bool(bot_app),
-            "database": "connected",
-            "handlers_count": len(bot_app.handlers) if bot_app else 0
-        },
-        "debug": {
-            "command": "Используйте /debug в боте",
-            "health_check": "https://ded1-8.onrender.com/health"
-        }
-    }
+    body = get_cached_body("status")
+    if body is None:
+        body = store_body("status", {
+            "server": {
+                "uptime": get_uptime(),
+                "port": PORT,
+                "startup_time": startup_time.isoformat()
+            },
+            "bot": {
+                "initialized": bot_ready.is_set(),
+                "database": "connected",
+                "handlers_count": len(bot_app.handlers) if bot_app else 0
+            },
+            "debug": STATUS_DEBUG
+        })
+    return Response(content=body, media_type="application/json")
+
+@app.post("/webhook/{secret}")
+async def telegram_webhook(secret: str, request: Request):
+    """Приём обновлений от Telegram"""
+    header_secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not (hmac.compare_digest(secret, WEBHOOK_SECRET)
+            and hmac.compare_digest(header_secret, WEBHOOK_SECRET)):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    
+    if not bot_ready.is_set():
+        # Telegram повторит доставку, когда бот запустится
+        raise HTTPException(status_code=503, detail="Bot is starting")
+    
+    update = Update.de_json(await request.json(), bot_app.bot)
+    dispatch_update(update)  # обработка идет в фоне, Telegram сразу получает ответ
+    return {"ok": True}
 
 @app.get("/ping")
 async def ping():
     """Ручной пинг"""
     return {
         "ping": "pong", 
-        "timestamp": datetime.now(timezone.utc).isoformat(),
-        "bot_initialized": bool(bot_app)
+        "timestamp": get_utc_timestamp(),
+        "bot_initialized": bot_ready.is_set()
     }
 
 # --- ОБРАБОТЧИКИ СОБЫТИЙ ---
-@app.on_event("startup")
 async def startup_event():
     """Запуск при старте приложения"""
+    global auto_ping_task
+    
     logger.info("=" * 60)
     logger.info("🚀 ЗАПУСК БОТА ДЛЯ ЗАПИСИ НА ПЕРЕРЫВЫ")
     logger.info("=" * 60)
     
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS, thread_name_prefix="bot-io")
+    )
+    
     # Инициализируем БД
-    init_db()
+    await init_db()
     
     logger.info(f"✅ Токен бота: {'Найден' if TOKEN else 'Не найден'}")
     logger.info(f"⏰ Время по Москве: {get_moscow_time()}")
@@ -772,8 +1241,8 @@ async def startup_event():
     logger.info(f"🌐 Порт: {PORT}")
     logger.info("=" * 60)
     
-    # Запускаем авто-пинг в отдельном потоке
-    start_auto_ping()
+    # Запускаем авто-пинг фоновой задачей
+    auto_ping_task = asyncio.create_task(auto_ping())
     logger.info("🔧 Авто-пинг запущен (пинг каждые 8 минут)")
     
     # Запускаем бота
@@ -786,21 +1255,28 @@ async def startup_event():
     else:
         logger.error("💥 Не удалось запустить бота!")
 
-@app.on_event("shutdown")
 async def shutdown_event():
     """Остановка при завершении"""
     logger.info("🛑 Завершение работы сервера...")
     
+    if auto_ping_task:
+        auto_ping_task.cancel()
+        await asyncio.gather(auto_ping_task, return_exceptions=True)
+    
+    bot_ready.clear()  # новые обновления получат 503, Telegram их повторит
+    await stop_chat_workers()
+    
     if bot_app:
         logger.info("🛑 Остановка Telegram бота...")
         try:
-            await bot_app.updater.stop()
             await bot_app.stop()
             await bot_app.shutdown()
             logger.info("✅ Telegram бот остановлен")
         except Exception as e:
             logger.error(f"❌ Ошибка при остановке бота: {e}")
     
+    await close_db()
+    
     logger.info("👋 Сервер остановлен")
 
 # --- ТОЧКА ВХОДА ---
@@ -810,12 +1286,24 @@ def main():
     logger.info(f"🔧 Версия: 2.1 с отладкой")
     logger.info(f"🚀 Start Command: python bot_server.py")
     
+    # Один воркер: бот и его состояние живут в этом процессе
     uvicorn.run(
         app,
         host="0.0.0.0",
         port=PORT,
+        # uvloop и httptools ставятся вместе с uvicorn[standard] (на Linux);
+        # "auto" берет их, если они есть, иначе asyncio и h11
+        loop="auto",
+        http="auto",
+        lifespan="on",
         access_log=False,  # Убираем лишние логи от Uvicorn
-        log_level="info"
+        log_level="warning",
+        timeout_keep_alive=75,
+        server_header=False,  # заголовки Server/Date никому не нужны
+        date_header=False,
+        # SIGTERM обрабатывает сам uvicorn и вызывает shutdown_event;
+        # Render ждет 30 секунд, поэтому зависшие запросы не ждем дольше 10
+        timeout_graceful_shutdown=10
     )
 
 if __name__ == "__main__":
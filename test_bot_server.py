@@ -0,0 +1,88 @@
+"""Проверки HTTP-эндпоинтов bot_server без запуска бота и сети"""
+import os
+from types import SimpleNamespace
+
+# Токен нужен только для импорта модуля: в Telegram запросы не уходят
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "1:test")
+
+import pytest
+from fastapi.testclient import TestClient
+
+import bot_server
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """Клиент без lifespan: startup_event (БД, вебхук, авто-пинг) не вызывается"""
+    monkeypatch.setattr(bot_server, "bot_app", None)
+    bot_server.bot_ready.clear()
+    bot_server.body_cache.clear()
+    yield TestClient(bot_server.app)
+    bot_server.bot_ready.clear()
+    bot_server.body_cache.clear()
+
+
+def test_health_unhealthy_when_bot_not_ready(client):
+    response = client.get("/health")
+
+    assert response.status_code == 503
+    assert response.json()["status"] == "unhealthy"
+    assert response.json()["bot_running"] is False
+
+
+def test_health_unhealthy_when_bot_stopped(client, monkeypatch):
+    monkeypatch.setattr(bot_server, "bot_app", SimpleNamespace(running=False))
+    bot_server.bot_ready.set()
+
+    response = client.get("/health")
+
+    assert response.status_code == 503
+    assert response.json()["status"] == "unhealthy"
+
+
+def test_health_healthy_when_bot_running(client, monkeypatch):
+    monkeypatch.setattr(bot_server, "bot_app", SimpleNamespace(running=True))
+    bot_server.bot_ready.set()
+
+    response = client.get("/health")
+
+    assert response.status_code == 200
+    assert response.json()["status"] == "healthy"
+    assert response.json()["version"] == "2.1"
+
+
+def test_health_not_cached_after_bot_stops(client, monkeypatch):
+    bot = SimpleNamespace(running=True)
+    monkeypatch.setattr(bot_server, "bot_app", bot)
+    bot_server.bot_ready.set()
+    assert client.get("/health").status_code == 200
+
+    # Закэшированный здоровый ответ не должен скрывать остановку бота
+    bot.running = False
+    assert client.get("/health").status_code == 503
+
+
+def test_webhook_rejects_wrong_secret(client):
+    response = client.post(
+        "/webhook/wrong",
+        json={"update_id": 1},
+        headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}
+    )
+
+    assert response.status_code == 403
+
+
+def test_webhook_rejects_missing_header(client):
+    response = client.post(f"/webhook/{bot_server.WEBHOOK_SECRET}", json={"update_id": 1})
+
+    assert response.status_code == 403
+
+
+def test_webhook_not_ready_returns_503(client):
+    response = client.post(
+        f"/webhook/{bot_server.WEBHOOK_SECRET}",
+        json={"update_id": 1},
+        headers={"X-Telegram-Bot-Api-Secret-Token": bot_server.WEBHOOK_SECRET}
+    )
+
+    assert response.status_code == 503